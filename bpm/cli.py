@@ -2,22 +2,45 @@ from __future__ import annotations
 
 import argparse
 import os
-import shlex
+import queue
+import selectors
+import signal
 import subprocess
 import sys
 import threading
 import time
-from typing import Optional
-
-from environs import Env
-from termcolor import colored
+from typing import TYPE_CHECKING, Optional
 
 from bpm import logger
-from bpm.config import Action, BPMConfig, Module, load_config
+from bpm.errors import BPMError
+
+# The config module pulls in pydantic, so it's only imported once the command line has been parsed. See `main()`.
+if TYPE_CHECKING:
+    from bpm.config import Action, BPMConfig, Module
+
+
+def _enable_windows_ansi_colors():
+    """
+    Make sure ANSI colors are enabled on Windows. This flips the console's virtual terminal processing flag directly,
+    rather than running `color` through a whole `cmd.exe` process just for its side effect.
+    """
+
+    import ctypes
+
+    try:
+        kernel32 = ctypes.windll.kernel32
+        stdout_handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+        mode = ctypes.c_ulong()
+        if kernel32.GetConsoleMode(stdout_handle, ctypes.byref(mode)):
+            # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+            kernel32.SetConsoleMode(stdout_handle, mode.value | 0x0004)
+    except (AttributeError, OSError):
+        pass
+
 
 # If running on Windows, make sure ANSI colors are enabled.
 if os.name == "nt":
-    os.system("color")
+    _enable_windows_ansi_colors()
 
 
 class Args:
@@ -25,10 +48,16 @@ class Args:
     """The selected module."""
     actions: list[Action]
     """The selected action. If an action group was selected, this contains a list of the actual actions underneath the action group."""
-    args: list[str] = []
+    args: list[str]
     """Optional additional arguments to pass to this action."""
 
-    def __init__(self, config: BPMConfig):
+    @staticmethod
+    def parse() -> argparse.Namespace:
+        """
+        Parse the command line. This doesn't need the config, so it's done before loading it. That way, `--help` and
+        usage errors don't have to wait for it.
+        """
+
         parser = argparse.ArgumentParser()
 
         parser.add_argument("--module", "-m", type=str)
@@ -39,31 +68,32 @@ class Args:
             help="Additional arguments to pass to the action, if allowed.",
         )
 
-        args = parser.parse_args()
+        return parser.parse_args()
+
+    def __init__(self, config: BPMConfig, args: argparse.Namespace):
+        self.module = None
+        self.args = []
 
         if args.module:
             # Is this module configured?
             if args.module not in config.modules.keys():
-                logger.error(
-                    f"Unknown module '{args.module}'. Allowed options are: {', '.join(config.modules.keys())}",
-                    exiting=True,
+                raise BPMError(
+                    f"Unknown module '{args.module}'. Allowed options are: {', '.join(config.modules.keys())}"
                 )
             self.module = config.modules[args.module]
 
             # Is this action configured?
             if args.action not in self.module.actions.keys():
-                logger.error(
-                    f"Action '{args.action}' is not defined for module '{args.module}'. Available actions are: {', '.join(self.module.actions.keys())}",
-                    exiting=True,
+                raise BPMError(
+                    f"Action '{args.action}' is not defined for module '{args.module}'. Available actions are: {', '.join(self.module.actions.keys())}"
                 )
             a = self.module.actions[args.action]
             self.actions = [a]
 
             # If args were given, make sure the action allows that.
             if args.args and not a.args:
-                logger.error(
-                    f"The '{args.action}' action on module '{args.module}' does not allow additional arguments, but {len(args.args)} were given.",
-                    exiting=True,
+                raise BPMError(
+                    f"The '{args.action}' action on module '{args.module}' does not allow additional arguments, but {len(args.args)} were given."
                 )
             self.args = args.args
 
@@ -72,9 +102,8 @@ class Args:
 
             # Is the given action name actually an action group?
             if args.action not in ags.keys():
-                logger.error(
-                    f"The '{args.action}' action is not used by more than one module. To run it, use the `-m <module>` argument to run it within that module's context.",
-                    exiting=True,
+                raise BPMError(
+                    f"The '{args.action}' action is not used by more than one module. To run it, use the `-m <module>` argument to run it within that module's context."
                 )
             self.actions = ags[args.action]
 
@@ -85,15 +114,18 @@ class Args:
                     (a.args if a.args else False) for a in self.actions
                 ]
                 if not any(actions_accepting_args):
-                    logger.error(
-                        f"None of the actions within the '{args.action}' action group accept additional arguments.",
-                        exiting=True,
+                    raise BPMError(
+                        f"None of the actions within the '{args.action}' action group accept additional arguments."
                     )
                 elif not all(actions_accepting_args):
                     yes = sum(actions_accepting_args)
                     no = len(self.actions) - sum(actions_accepting_args)
                     logger.warn(
-                        f"Additional arguments were given to the '{args.action}' action group, but only {yes} of {len(self.actions)} actions accept them. The arguments will be ignored for the other {'action' if no <= 1 else f'{no} actions'}."
+                        "Additional arguments were given to the '%s' action group, but only %d of %d actions accept them. The arguments will be ignored for the other %s.",
+                        args.action,
+                        yes,
+                        len(self.actions),
+                        "action" if no <= 1 else f"{no} actions",
                     )
             self.args = args.args
 
@@ -105,8 +137,12 @@ class ActionRunner:
     """Can these actions run simultaneously?"""
     action_args: list[str]
     """Args to pass to each action, if applicable and given."""
-    processes: dict[Action, subprocess.Popen] = {}
+    processes: dict[Action, subprocess.Popen]
     """Running process objects for each action."""
+    _selector: Optional[selectors.BaseSelector]
+    """Selector watching the running processes' pidfds and output pipes. Only used on platforms with pidfds."""
+    _buffers: dict[int, bytearray]
+    """Partial lines read from each output pipe, keyed by file descriptor."""
 
     def __init__(self, args: Args):
         # if not isinstance(actions, list):
@@ -114,21 +150,86 @@ class ActionRunner:
         self.actions = args.actions
         self.can_run_simultaneously = all([a.bg for a in self.actions])
         self.action_args = args.args
+        self.processes = {}
+        self._selector = None
+        self._buffers = {}
 
     @staticmethod
-    def _stream_output(stream, prefix: str):
+    def _output_prefix(action: Action, stream: str) -> str:
+        """
+        Get the prefix printed before each line of an action's output. `stream` is either "out" or "err". This is only
+        built once per pipe, when we start following it.
+        """
+        from termcolor import colored
+
+        prefix = f"{action.module_name}.{action.name}"
+        if stream == "err":
+            # Make those error messages pop!
+            prefix += f" {colored('ERR', 'red')}"
+        return prefix
+
+    @classmethod
+    def _stream_output(cls, stream, prefix: str):
         """
         Read from a stream and print each line with a prefix.
         """
+        buffer = bytearray()
         try:
-            for line in iter(stream.readline, b""):
-                if line:
-                    print(f"[{prefix}] {line.decode('utf-8').rstrip()}")
+            # read1() hands back whatever is available (up to 64 KiB) in one go, rather than re-entering the
+            # interpreter for every single line like readline() does.
+            while chunk := stream.read1(65536):
+                cls._print_lines(buffer, chunk, prefix)
+            cls._print_lines(buffer, b"", prefix)
         except Exception as e:
-            logger.error(f"[{prefix}] Error reading stream: {e}")
+            logger.error("[%s] Error reading stream: %s", prefix, e)
         finally:
             stream.close()
 
+    @staticmethod
+    def _widen_pipes(proc: subprocess.Popen):
+        """
+        Try to widen the kernel buffers of a process's output pipes to 1 MiB, so chatty actions block less on a full
+        pipe and their output gets read in bigger chunks. This is only a hint: it's Linux-only, and the kernel refuses
+        it once the user is over their pipe buffer limits, in which case the default size is kept.
+        """
+
+        try:
+            import fcntl
+        except ImportError:
+            # Not available on Windows.
+            return
+
+        if not hasattr(fcntl, "F_SETPIPE_SZ"):
+            return
+
+        for stream in (proc.stdout, proc.stderr):
+            try:
+                fcntl.fcntl(stream.fileno(), fcntl.F_SETPIPE_SZ, 1 << 20)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _print_lines(buffer: bytearray, data: bytes, prefix: str):
+        """
+        Add a chunk of raw output to a stream's buffer, then print each complete line in it with a prefix. An empty
+        chunk means the stream hit EOF, so whatever is left in the buffer gets printed as well.
+        """
+        if data:
+            buffer += data
+            *lines, tail = buffer.split(b"\n")
+            buffer[:] = tail
+        else:
+            lines = [bytes(buffer)] if buffer else []
+            buffer.clear()
+
+        # Write the whole batch at once, so lines from other streams can't end up interleaved with it.
+        sys.stdout.write(
+            "".join(
+                f"[{prefix}] {line.decode('utf-8', 'replace').rstrip()}\n"
+                for line in lines
+            )
+        )
+
     def run(self):
         """
         Run the selected commands.
@@ -136,15 +237,13 @@ class ActionRunner:
 
         if self.can_run_simultaneously:
             logger.info("Running all actions within the action group simultaneously.\n")
+            self._interrupt_on_termination_signals()
             try:
                 # Start all processes
                 for action in self.actions:
-                    # Create a prefix for this action's output
-                    prefix = f"{action.module_name}.{action.name}"
+                    logger.info("Running action %s", action)
 
-                    logger.info(f"Running action {action}")
-
-                    command: list[str] = shlex.split(action.cmd) + self.action_args
+                    command: list[str] = action.argv + self.action_args
 
                     # Start the process in the action's intended CWD.
                     try:
@@ -153,49 +252,19 @@ class ActionRunner:
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE,
                             cwd=action.work_dir,
+                            # Give each action its own process group, so it (and anything it spawns) can be stopped
+                            # as a whole. See `_kill_all_processes()`.
+                            start_new_session=True,
                         )
                     except FileNotFoundError as e:
                         missing_file = str(e.filename)
-                        logger.error(
-                            # str(e.strerror) + missing_file,
-                            f"{e.strerror}: {missing_file}",
-                            exiting=True,
-                        )
-
-                    # Start threads to follow stdout and stderr
-                    stdout_thread = threading.Thread(
-                        target=self._stream_output,
-                        args=(proc.stdout, prefix),
-                        daemon=True,
-                    )
-                    stderr_thread = threading.Thread(
-                        target=self._stream_output,
-                        args=(
-                            proc.stderr,
-                            f"{prefix} {colored('ERR', 'red')}",
-                        ),  # make those error messages pop!
-                        daemon=True,
-                    )
-
-                    stdout_thread.start()
-                    stderr_thread.start()
+                        raise BPMError(f"{e.strerror}: {missing_file}") from e
 
+                    self._widen_pipes(proc)
                     self.processes[action] = proc
 
-                # Wait for all processes to complete
-                while self.processes:
-                    # Check each process
-                    for action, proc in list(self.processes.items()):
-                        # poll() returns None if still running, otherwise returns exit code
-                        if proc.poll() is not None:
-                            logger.info(
-                                f"Action {action} completed with exit code {proc.returncode}"
-                            )
-                            del self.processes[action]
-
-                    # Small sleep to avoid busy waiting
-                    if self.processes:
-                        time.sleep(0.1)
+                # Follow their output and wait for all of them to complete
+                self._follow_processes()
 
                 print()
                 logger.info("All actions completed.")
@@ -205,6 +274,14 @@ class ActionRunner:
                 logger.warn("Received interrupt, killing all child processes...")
                 self._kill_all_processes()
                 sys.exit(1)
+            finally:
+                # If something went wrong partway through (e.g. an action couldn't be started), don't leave the
+                # actions that did start running.
+                if self.processes:
+                    self._kill_all_processes()
+                # Only stop following output once the actions are gone, so nothing they print while shutting down
+                # is lost (or sent into a closed pipe).
+                self._close_pipes()
         else:
             logger.info(
                 "One or more actions within the action group cannot run simultaneously. Running them in series."
@@ -213,8 +290,8 @@ class ActionRunner:
                 # Create a prefix for this action's output
                 # prefix = f"{action.module_name}.{action.name}"
                 print()
-                logger.info(f"Running action {action}")
-                command: list[str] = shlex.split(action.cmd) + self.action_args
+                logger.info("Running action %s", action)
+                command: list[str] = action.argv + self.action_args
 
                 try:
                     proc = subprocess.run(
@@ -222,49 +299,303 @@ class ActionRunner:
                         cwd=action.work_dir,
                     )
                     logger.info(
-                        f"Action {action} completed with exit code {proc.returncode}"
+                        "Action %s completed with exit code %d", action, proc.returncode
                     )
                 except FileNotFoundError as e:
                     missing_file = str(e.filename)
-                    logger.error(
-                        f"{e.strerror}: {missing_file}",
-                        exiting=True,
-                    )
+                    raise BPMError(f"{e.strerror}: {missing_file}") from e
 
             print()
             logger.info("All processes completed")
 
-    def _kill_all_processes(self):
+    def _follow_processes(self):
         """
-        Kill all running child processes.
+        Print the output of every running process and block until they have all exited, logging each one as it
+        completes.
+
+        On Linux, a single selector watches each process's stdout and stderr pipes along with a pidfd for the process
+        itself, so we sleep in the kernel until there is output to print or a child has actually exited. Elsewhere,
+        reader and waiter threads are used instead.
         """
 
+        if not hasattr(os, "pidfd_open"):
+            return self._follow_processes_with_threads()
+
+        sel = selectors.DefaultSelector()
+        try:
+            for action, proc in self.processes.items():
+                sel.register(
+                    os.pidfd_open(proc.pid), selectors.EVENT_READ, (action, "exit")
+                )
+        except OSError:
+            # Kernel is too old for pidfd_open() (pre-5.3).
+            for key in sel.get_map().values():
+                os.close(key.fd)
+            sel.close()
+            return self._follow_processes_with_threads()
+
+        # From here on, the pipes are closed by `_close_pipes()`, after all processes have exited.
+        self._selector = sel
         for action, proc in self.processes.items():
-            try:
-                # Send SIGTERM first (graceful)
-                proc.terminate()
-                # Wait up to 3 seconds for graceful termination
+            for stream, kind in ((proc.stdout, "out"), (proc.stderr, "err")):
+                os.set_blocking(stream.fileno(), False)
+                sel.register(
+                    stream,
+                    selectors.EVENT_READ,
+                    (action, kind, self._output_prefix(action, kind)),
+                )
+                self._buffers[stream.fileno()] = bytearray()
+
+        self._handle_events()
+
+    def _handle_events(self, deadline: Optional[float] = None):
+        """
+        Print output and handle exiting processes as events come in on the selector, until every process has exited
+        or the `deadline` (from `time.monotonic()`) has passed.
+        """
+
+        assert self._selector is not None
+
+        while self.processes:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return
+
+            for key, _ in self._selector.select(timeout):
+                if key.data[1] == "exit":
+                    self._finish_process(key)
+                # Skip pipes that were already closed while handling another event from this batch.
+                elif key.fd in self._buffers:
+                    self._read_output(key)
+
+    def _close_pipes(self):
+        """
+        Stop following output, closing the selector along with every pipe and pidfd still registered with it.
+        """
+
+        if self._selector is None:
+            return
+
+        for key in list(self._selector.get_map().values()):
+            if isinstance(key.fileobj, int):
+                os.close(key.fileobj)
+            else:
+                key.fileobj.close()
+        self._selector.close()
+        self._selector = None
+        self._buffers.clear()
+
+    def _read_output(self, key: selectors.SelectorKey) -> bool:
+        """
+        Read the next chunk of output from one of a process's pipes and print it. At EOF, the pipe is closed.
+
+        Returns
+        -------
+        :returns bool: Whether any output was read, meaning there may be more available right away.
+        """
+
+        assert self._selector is not None
+
+        _, _, prefix = key.data
+        try:
+            data = os.read(key.fd, 65536)
+        except BlockingIOError:
+            return False
+
+        self._print_lines(self._buffers[key.fd], data, prefix)
+
+        if not data:
+            del self._buffers[key.fd]
+            self._selector.unregister(key.fileobj)
+            key.fileobj.close()
+
+        return bool(data)
+
+    def _finish_process(self, key: selectors.SelectorKey):
+        """
+        Handle a process that has exited: print the output still sitting in its pipes, reap it, and log its exit code.
+        """
+
+        assert self._selector is not None
+
+        action = key.data[0]
+        proc = self.processes.pop(action)
+        self._selector.unregister(key.fd)
+        os.close(key.fd)
+
+        # The process is gone, so everything it wrote is already in the pipes. Pipes that already hit EOF are closed.
+        for stream in (proc.stdout, proc.stderr):
+            if stream.closed:
+                continue
+            stream_key = self._selector.get_key(stream)
+            while self._read_output(stream_key):
+                pass
+
+        proc.wait()
+        logger.info("Action %s completed with exit code %d", action, proc.returncode)
+
+    def _follow_processes_with_threads(self):
+        """
+        Fallback for `_follow_processes()` on platforms without pidfds. Each pipe gets a reader thread, and each process
+        gets a waiter thread that reports its completion through a queue.
+        """
+
+        done: queue.Queue[Action] = queue.Queue()
+
+        def wait(
+            action: Action, proc: subprocess.Popen, readers: list[threading.Thread]
+        ):
+            proc.wait()
+            # Don't report the action as completed until all of its output has been printed.
+            for reader in readers:
+                reader.join()
+            done.put(action)
+
+        for action, proc in self.processes.items():
+            readers = [
+                threading.Thread(
+                    target=self._stream_output,
+                    args=(stream, self._output_prefix(action, kind)),
+                    daemon=True,
+                )
+                for stream, kind in ((proc.stdout, "out"), (proc.stderr, "err"))
+            ]
+            for reader in readers:
+                reader.start()
+            threading.Thread(
+                target=wait, args=(action, proc, readers), daemon=True
+            ).start()
+
+        while self.processes:
+            action = done.get()
+            proc = self.processes.pop(action)
+            logger.info(
+                "Action %s completed with exit code %d", action, proc.returncode
+            )
+
+    @staticmethod
+    def _interrupt_on_termination_signals():
+        """
+        Treat SIGHUP, SIGTERM and SIGQUIT like Ctrl-C. Simultaneous actions run in their own sessions, so these signals
+        don't reach them on their own (e.g. when the terminal is closed). Raising `KeyboardInterrupt` sends them through
+        `_kill_all_processes()` instead of leaving them running.
+        """
+
+        if os.name != "posix":
+            return
+
+        signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGQUIT)
+
+        def handler(signum: int, frame):
+            # Don't let a follow-up signal cut the cleanup short.
+            for sig in signals:
+                signal.signal(sig, signal.SIG_IGN)
+
+            if signum == signal.SIGHUP:
+                # The terminal is gone, so there's nowhere left to print to.
+                sys.stdout = sys.stderr = open(os.devnull, "w")
+
+            raise KeyboardInterrupt
+
+        for sig in signals:
+            signal.signal(sig, handler)
+
+    @staticmethod
+    def _stop_process(proc: subprocess.Popen, force: bool = False):
+        """
+        Ask a process to stop with SIGTERM, or kill it outright with SIGKILL if `force` is set. On POSIX systems, the
+        signal goes to the process's whole group, so anything it spawned is stopped too.
+        """
+
+        if proc.returncode is not None:
+            return
+
+        if os.name != "posix":
+            proc.kill() if force else proc.terminate()
+            return
+
+        try:
+            os.killpg(proc.pid, signal.SIGKILL if force else signal.SIGTERM)
+        except ProcessLookupError:
+            # It already exited.
+            pass
+
+    def _wait_for_exit(
+        self, procs: list[subprocess.Popen], timeout: Optional[float] = None
+    ) -> list[subprocess.Popen]:
+        """
+        Wait up to `timeout` seconds in total (or indefinitely, if not set) for the given processes to exit. On
+        platforms with pidfds, this keeps printing their output while waiting.
+
+        Returns
+        -------
+        :returns list[subprocess.Popen]: The processes that are still running.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        if self._selector is not None:
+            self._handle_events(deadline)
+        else:
+            for proc in procs:
                 try:
-                    proc.wait(timeout=3)
+                    proc.wait(
+                        timeout=None
+                        if deadline is None
+                        else max(0, deadline - time.monotonic())
+                    )
                 except subprocess.TimeoutExpired:
-                    # If still running, force kill with SIGKILL
-                    proc.kill()
-                    proc.wait()
-                logger.info(f"Killed process for {action} (PID: {proc.pid})")
+                    pass
+
+        return [proc for proc in procs if proc.poll() is None]
+
+    def _kill_all_processes(self):
+        """
+        Kill all running child processes.
+        """
+
+        # Work from a snapshot, since processes can exit (and be reaped) while they're being stopped.
+        processes = list(self.processes.items())
+
+        # Send SIGTERM to all of them first (graceful), so they shut down at the same time rather than one by one.
+        for action, proc in processes:
+            try:
+                self._stop_process(proc)
             except Exception as e:
-                logger.error(f"Error killing process for {action}: {e}", exiting=False)
+                logger.error("Error killing process for %s: %s", action, e)
+
+        # Wait up to 3 seconds for graceful termination. If any are still running, force kill them with SIGKILL.
+        procs = [proc for _, proc in processes]
+        for proc in self._wait_for_exit(procs, timeout=3):
+            self._stop_process(proc, force=True)
+        self._wait_for_exit(procs)
+
+        for action, proc in processes:
+            logger.info("Killed process for %s (PID: %d)", action, proc.pid)
         self.processes.clear()
 
 
 def main():
+    parsed_args = Args.parse()
+
+    from environs import Env
+
+    from bpm.config import load_config
+
     env = Env()
     BPM_CONFIG_PATH = env.str("BPM_CONFIG_PATH", None)
-    config = load_config(BPM_CONFIG_PATH)
 
-    args = Args(config)
+    try:
+        config = load_config(BPM_CONFIG_PATH)
+        args = Args(config, parsed_args)
 
-    runner = ActionRunner(args)
-    runner.run()
+        runner = ActionRunner(args)
+        runner.run()
+    except BPMError as e:
+        logger.error(str(e))
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,14 +1,22 @@
 from __future__ import annotations
 
+import os
+import shlex
 import subprocess
+from functools import cached_property, lru_cache
 from pathlib import Path
 from typing import Any, Optional, Self
 
-import toml_rs as toml
-import yaml
-from pydantic import BaseModel, ConfigDict, computed_field, model_validator
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    ValidationError,
+    computed_field,
+    model_validator,
+)
 
 from bpm import logger
+from bpm.errors import BPMError
 
 
 def rebase_path(new_root: Path | str, subdir: Path | str) -> Path:
@@ -25,32 +33,16 @@ def rebase_path(new_root: Path | str, subdir: Path | str) -> Path:
     :returns Path: The rebased path. If the subdirectory was already relative to the new root, it's returned as-is.
     """
 
-    # Temporarily convert thie subdir to a Path (if it isn't already).
-    if not isinstance(subdir, Path):
-        subdir = Path(subdir)
-    try:
-        # If the subdir is already relative to the new root, just return it as-is.
-        subdir.relative_to(new_root)
-        return subdir
-    except ValueError:
-        # In this case, the subdir is *not* already relative, so we need to fix it.
-        pass
-
-    # Root needs to be of type Path.
-    if not isinstance(new_root, Path):
-        new_root = Path(new_root)
-
-    # Subdir needs to be a string, as we're doing some manual mangling.
-    if not isinstance(subdir, str):
-        subdir = str(subdir)
-
-    # original_path = str(data['path'])
-    if subdir[0] == "/":
-        rootless_path = subdir[1:]
-    else:
-        rootless_path = subdir
+    root = os.fspath(new_root).rstrip(os.sep)
+    path = os.fspath(subdir)
 
-    return new_root / rootless_path
+    # If the subdir is already relative to the new root, just return it as-is. This is a plain string comparison, rather
+    # than trying `Path.relative_to()` and catching the error when it isn't.
+    if path.rstrip(os.sep) == root or path.startswith(root + os.sep):
+        return Path(path)
+
+    # In this case, the subdir is *not* already relative, so strip its leading slash and put it under the new root.
+    return Path(new_root) / path.lstrip("/")
 
 
 class Action(BaseModel):
@@ -77,6 +69,19 @@ class Action(BaseModel):
     def __str__(self) -> str:
         return f"{self.module_name}.{self.name}"  # ({self.cmd})"
 
+    @cached_property
+    def argv(self) -> list[str]:
+        """
+        The command, split into arguments. Since actions are frozen, this only needs to be done once.
+        """
+
+        # Most commands are just words separated by spaces. Without any quoting or escaping (and with no unusual
+        # whitespace, which `str.split()` would treat differently), a plain split gives the same result as shlex.
+        if self.cmd.isprintable() and not any(c in self.cmd for c in "'\"\\"):
+            return self.cmd.split()
+
+        return shlex.split(self.cmd)
+
 
 class Module(BaseModel):
     name: str
@@ -85,11 +90,11 @@ class Module(BaseModel):
 
     @model_validator(mode="before")
     @classmethod
-    def set_additional_action_fields(cls, data: dict) -> Any:
+    def set_additional_fields(cls, data: dict) -> Any:
         """
         Some fields of each Action config are not set in the config (by design), but are extremely helpful when actually
         using that config in code. Some fields are only optional in the config, but are very much required here. This
-        *before validator* sets those fields.
+        *before validator* sets those fields, after rebasing this Module's working directory onto the Git repo.
 
         Fields
         ------
@@ -103,13 +108,17 @@ class Module(BaseModel):
         - `module_name`: Set this to the module's name. Helpful when trying to figure out what Module each Action is associated with.
         """
 
-        repo_root = get_git_repo_root()
-
         if not isinstance(data, dict):
             raise TypeError("Not dict.")
 
-        # Grab the raw action configs
-        actions: dict[str, dict[str, Any]] = dict(data["actions"])
+        repo_root = get_git_repo_root()
+
+        # Rebase this module's working directory onto the Git repo. This has to happen first, as it's inherited by
+        # actions that don't set their own.
+        data["work_dir"] = str(rebase_path(repo_root, data["work_dir"]))
+
+        # Grab the raw action configs. These are modified in-place.
+        actions: dict[str, dict[str, Any]] = data["actions"]
         module_name: str = data["name"]
 
         for k, a in actions.items():
@@ -123,23 +132,7 @@ class Module(BaseModel):
             a["name"] = k
             # Set the parent module's name in the raw action data.
             a["module_name"] = module_name
-            # Make sure the action is updated in the dictionary.
-            actions[k] = a
 
-        # Make sure the modified actions are saved to the raw data.
-        data["actions"] = actions
-
-        return data
-
-    @model_validator(mode="before")
-    def rebase_workdir_onto_git_repo_root(cls, data: dict) -> Any:
-        """
-        This *before validator* just rebases the working directory onto the git repository.
-        """
-
-        assert isinstance(data, dict)
-        repo_root = get_git_repo_root()
-        data["work_dir"] = str(rebase_path(repo_root, data["work_dir"]))
         return data
 
     @model_validator(mode="after")
@@ -180,23 +173,17 @@ class BPMConfig(BaseModel):
 
         assert isinstance(data, dict)
 
-        # Grab the raw module data.
-        modules: dict[str, dict[str, Any]] = dict(data["modules"])
+        # Grab the raw module data. These are modified in-place.
+        modules: dict[str, dict[str, Any]] = data["modules"]
 
         for k, m in modules.items():
-            # Set the `name` property, and make sure it saves.
+            # Set the `name` property.
             m["name"] = k
 
-            # Make sure the updated module data is saved.
-            modules[k] = m
-
-        # Make sure the modified modules are saved to the raw data.
-        data["modules"] = modules
-
         return data
 
     @computed_field
-    @property
+    @cached_property
     def all_actions(self) -> dict[str, list[Action]]:
         """
         All actions, collected from all modules. If two or more modules have actions with the same name,
@@ -218,7 +205,7 @@ class BPMConfig(BaseModel):
         return cmds
 
     @computed_field
-    @property
+    @cached_property
     def action_groups(self) -> dict[str, list[Action]]:
         """
         All actions that have been defined in two or more modules are considered part of an action group.
@@ -229,91 +216,144 @@ class BPMConfig(BaseModel):
         return {n: d for n, d in self.all_actions.items() if len(d) > 1}
 
 
+@lru_cache(maxsize=1)
 def get_git_repo_root() -> Path:
+    """
+    Get the root of the Git repo we're running in. The result is cached, since it can't change during a run and
+    finding it means spawning `git`.
+    """
+
     proc = subprocess.run(
         args=["git", "rev-parse", "--show-toplevel"],
         stdout=subprocess.PIPE,
+        # We report not being in a repo ourselves.
+        stderr=subprocess.DEVNULL,
         encoding="utf-8",
     )
 
     if proc.returncode > 0:
-        raise FileNotFoundError("Not in a Git repository.")
+        raise BPMError("Not in a Git repository.")
 
     return Path(proc.stdout.strip())
 
 
 def load_yaml(yaml_file: Path | str):
+    import yaml
+
     if not isinstance(yaml_file, Path):
         yaml_file = Path(yaml_file)
 
-    with open(yaml_file, "r") as y:
-        return yaml.safe_load(y)
+    # Hand the parser raw bytes and let it do the decoding.
+    with open(yaml_file, "rb") as y:
+        try:
+            # Use the libyaml-backed loader when PyYAML was built with it.
+            return yaml.load(y, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+        except yaml.YAMLError as e:
+            raise BPMError(f"Config file '{yaml_file}' is not valid YAML: {e}") from e
 
 
 def load_toml(toml_file: Path | str):
+    import toml_rs as toml
+
     if not isinstance(toml_file, Path):
         toml_file = Path(toml_file)
 
-    with open(toml_file, "r") as t:
-        return toml.loads(t.read())
+    with open(toml_file, "rb") as t:
+        try:
+            return toml.load(t)
+        except toml.TOMLDecodeError as e:
+            raise BPMError(f"Config file '{toml_file}' is not valid TOML: {e}") from e
+
+
+CONFIG_FILE_NAMES = ("bpm.toml", "bpm.yml", "bpm.yaml")
+"""Config file names to look for, in order of preference."""
+
+
+def find_config_file() -> Optional[Path]:
+    """
+    Find the config file. The Git repo's root is checked first, then the current directory and each of its parents up
+    to the repo root. Directories outside the repo are never searched, and neither are ones below the current
+    directory. To use a config file elsewhere, set `BPM_CONFIG_PATH`.
+
+    Returns
+    -------
+    :returns Path | None: The config file that was found, if any.
+    """
+
+    repo_root = get_git_repo_root()
+
+    directories = [repo_root]
+    cwd = Path.cwd()
+    for directory in (cwd, *cwd.parents):
+        if directory == repo_root or not directory.is_relative_to(repo_root):
+            break
+        directories.append(directory)
+
+    for directory in directories:
+        for name in CONFIG_FILE_NAMES:
+            if (p := directory / name).exists():
+                return p
+
+    return None
 
 
 def load_config(config_file: Optional[Path | str] = None):
     if not config_file:
-        repo_root = get_git_repo_root()
+        config_file = find_config_file()
 
-        if (p := repo_root / "bpm.toml").exists():
-            config_file = p
-        elif (p := repo_root / "bpm.yml").exists() or (
-            p := repo_root / "bpm.yaml"
-        ).exists():
-            config_file = p
-
-        # Try searching for it with glob. Pick the first one found, if any.
-        found_files = (
-            [f for f in Path.cwd().rglob("bpm.toml")]
-            + [f for f in Path.cwd().rglob("bpm.yml")]
-            + [f for f in Path.cwd().rglob("bpm.yaml")]
-        )
-
-        if not found_files:
-            raise FileNotFoundError("Config file not found in repo")
-        else:
-            config_file = found_files[0]
+        if not config_file:
+            raise BPMError(
+                f"Config file not found in repo. Create one of: {', '.join(CONFIG_FILE_NAMES)}, or set BPM_CONFIG_PATH."
+            )
 
     else:
         if not isinstance(config_file, Path):
             config_file = Path(config_file)
 
         if not config_file.exists():
-            raise FileNotFoundError(f"Config file {config_file} does not exist.")
+            raise BPMError(f"Config file {config_file} does not exist.")
 
     # The `config_file` variable should be set and be of type `Path`.
     assert isinstance(config_file, Path)
 
-    logger.info(f"Using '{config_file}'")
+    logger.info("Using '%s'", config_file)
 
-    if config_file.suffix == ".toml":
-        data = load_toml(config_file)
-    elif config_file.suffix == (".yml" or ".yaml"):
-        data = load_yaml(config_file)
+    try:
+        if config_file.suffix == ".toml":
+            data = load_toml(config_file)
+        elif config_file.suffix in (".yml", ".yaml"):
+            data = load_yaml(config_file)
+        else:
+            raise BPMError(
+                f"Unknown config file type '{config_file.suffix}'. Use one of: {', '.join(CONFIG_FILE_NAMES)}"
+            )
+    except OSError as e:
+        raise BPMError(
+            f"Could not read config file '{config_file}': {e.strerror}"
+        ) from e
 
     # data = load_yaml(config_file)
 
-    return BPMConfig.model_validate(data)
+    try:
+        return BPMConfig.model_validate(data)
+    except ValidationError as e:
+        raise BPMError(f"Config file '{config_file}' is invalid. {e}") from e
 
 
 def convert_toml_to_yaml(toml_file: Path, yaml_file: Path):
+    import toml_rs as toml
+    import yaml
+
     if not isinstance(yaml_file, Path):
         yaml_file = Path(yaml_file)
     if not isinstance(toml_file, Path):
         toml_file = Path(toml_file)
 
     with (
-        open(toml_file, "r") as t,
+        open(toml_file, "rb") as t,
         open(yaml_file, "w+") as y,
     ):
-        data = toml.loads(t.read())
+        data = toml.load(t)
         yaml.safe_dump(
             data=data,
             stream=y,
@@ -321,14 +361,17 @@ def convert_toml_to_yaml(toml_file: Path, yaml_file: Path):
 
 
 def convert_yaml_to_toml(yaml_file: Path, toml_file: Path):
+    import toml_rs as toml
+    import yaml
+
     if not isinstance(yaml_file, Path):
         yaml_file = Path(yaml_file)
     if not isinstance(toml_file, Path):
         toml_file = Path(toml_file)
 
     with (
-        open(yaml_file, "r") as y,
+        open(yaml_file, "rb") as y,
         open(toml_file, "w+") as t,
     ):
-        data = yaml.safe_load(y)
+        data = yaml.load(y, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
         toml.dump(data, t)
@@ -0,0 +1,5 @@
+class BPMError(Exception):
+    """
+    An error that stops BPM, such as an unknown module or action. Raise this instead of exiting on the spot, so that
+    cleanup (like stopping running actions) still happens. `bpm.cli.main()` prints the message and exits.
+    """
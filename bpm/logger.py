@@ -1,32 +1,52 @@
-from termcolor import colored
+import sys
+from functools import cache
 
 
-def debug(message: str):
+@cache
+def _label(level: str, color: str) -> str:
     """
-    Print a debug message on the screen.
+    Get the colored label for a log level. Whether colors can be used at all (TTY, `NO_COLOR`, etc.) won't change while
+    running, so each label only needs to be built once.
     """
-    print(colored("DEBUG", "blue") + ": " + message)
+    from termcolor import colored
 
+    return colored(level, color)
 
-def info(message: str):
+
+def _format(message: str, args: tuple) -> str:
+    """
+    Fill printf-style `%` placeholders in a message with its arguments. Messages without arguments are left as-is, so
+    they can contain a literal `%`.
+    """
+    return message % args if args else message
+
+
+def debug(message: str, *args):
     """
-    Print an info message on the screen.
+    Print a debug message on the screen. Any `args` are formatted into the message printf-style.
     """
-    print("INFO: " + message)
+    sys.stdout.write(_label("DEBUG", "blue") + ": " + _format(message, args) + "\n")
 
 
-def warn(message: str):
+def info(message: str, *args):
     """
-    Print a warning message on the screen.
+    Print an info message on the screen. Any `args` are formatted into the message printf-style.
     """
-    print(colored("WARN", "yellow") + ": " + message)
+    sys.stdout.write("INFO: " + _format(message, args) + "\n")
 
 
-def error(message: str, exiting: bool = True):
+def warn(message: str, *args):
     """
-    Print an error message on the screen. Optionally exit the program after printing.
+    Print a warning message on the screen. Any `args` are formatted into the message printf-style.
     """
-    print(colored("ERROR", "red") + ": " + message)
+    sys.stdout.write(_label("WARN", "yellow") + ": " + _format(message, args) + "\n")
 
-    if exiting:
-        exit(1)
+
+def error(message: str, *args):
+    """
+    Print an error message on the screen. Any `args` are formatted into the message printf-style.
+
+    This doesn't exit the program. To stop with an error, raise `bpm.errors.BPMError` instead, which `bpm.cli.main()`
+    prints before exiting.
+    """
+    sys.stdout.write(_label("ERROR", "red") + ": " + _format(message, args) + "\n")